@@ -12,6 +12,8 @@ class UnknownDefaultError(Exception):
 
 
 class _Defaults:
+    __slots__ = ("_opts",)
+
     _DEFAULT_CONFIG = {
         RETRIES: 1,  # A flaky mark with 0 args should default to 1 retry.
         RETRY_DELAY: 0,
@@ -35,22 +37,25 @@ class _Defaults:
             raise ValueError(f"{name} is already an existing default!")
         self._opts[name] = value
 
-    def load_ini(self, config: pytest.Config) -> None:
+    def read_ini(self, config: pytest.Config) -> dict[str, Any]:
         """
         Pytest has separate methods for loading command line args and ini options. All ini
         values are stored as strings so must be converted to the proper type.
         """
-        self._opts[RETRIES] = int(config.getini(RETRIES.lower()))
-        self._opts[RETRY_DELAY] = float(config.getini(RETRY_DELAY.lower()))
-        self._opts[CUMULATIVE_TIMING] = config.getini(CUMULATIVE_TIMING.lower())
-        self._opts[RETRY_OUTCOME] = config.getini(RETRY_OUTCOME.lower())
+        return {
+            RETRIES: int(config.getini(RETRIES.lower())),
+            RETRY_DELAY: float(config.getini(RETRY_DELAY.lower())),
+            CUMULATIVE_TIMING: config.getini(CUMULATIVE_TIMING.lower()),
+            RETRY_OUTCOME: config.getini(RETRY_OUTCOME.lower()),
+        }
 
     def configure(self, config: pytest.Config) -> None:
-        if config.getini("retries"):
-            self.load_ini(config)
+        # Command line args take precedence over ini options, so apply them last
+        updates = self.read_ini(config) if config.getini("retries") else {}
         for key in self._opts:
             if (val := config.getoption(key.lower())) is not None:
-                self._opts[key] = val
+                updates[key] = val
+        self._opts.update(updates)
 
 
 Defaults = _Defaults()
@@ -1,9 +1,13 @@
 import pytest
 import bdb
+from array import array
 from time import sleep
+from functools import partial
 from logging import LogRecord
-from traceback import format_exception
+from traceback import TracebackException
+from types import TracebackType
 from typing import Any, Generator, Optional
+from collections import deque
 from collections.abc import Iterable
 from pytest_retry.configs import Defaults
 from pytest_retry.server import ReportHandler, OfflineReporter, ReportServer, ClientReporter
@@ -15,7 +19,17 @@ outcome_key = pytest.StashKey[str]()
 attempts_key = pytest.StashKey[int]()
 duration_key = pytest.StashKey[float]()
 server_port_key = pytest.StashKey[int]()
+fake_next_item_key = pytest.StashKey[pytest.Class]()
 stages = ("setup", "call", "teardown")
+# Index of each stage in the outcome and duration sequences kept in node_stats
+stage_index = {stage: i for i, stage in enumerate(stages)}
+SETUP, CALL, TEARDOWN = range(len(stages))
+# Snapshots of Defaults used on the hot path. Options can't change once pytest_configure
+# has run, so these are refreshed there instead of going through Defaults for every item
+default_retries: int = Defaults.RETRIES
+default_retry_delay: float = Defaults.RETRY_DELAY
+default_cumulative_timing: bool = Defaults.CUMULATIVE_TIMING
+retry_outcome: str = Defaults.RETRY_OUTCOME
 RETRY = 0
 FAIL = 1
 EXIT = 2
@@ -32,6 +46,8 @@ class ExceptionFilter:
     and whether the exception exists within the list
     """
 
+    __slots__ = ("list_type", "filter")
+
     def __init__(self, expected_exceptions: Iterable, excluded_exceptions: Iterable):
         if expected_exceptions and excluded_exceptions:
             raise ConfigurationError(
@@ -39,54 +55,119 @@ class ExceptionFilter:
                 "be defined simultaneously."
             )
         self.list_type = bool(expected_exceptions)
-        self.filter = expected_exceptions or excluded_exceptions or []
-
-    def __call__(self, exception_type: Optional[type[BaseException]]) -> bool:
+        exceptions = expected_exceptions or excluded_exceptions or ()
         try:
-            return not self.filter or bool(self.list_type == bool(exception_type in self.filter))
+            # A string is iterable too, but would be split into characters
+            if isinstance(exceptions, (str, bytes)):
+                raise TypeError
+            self.filter = frozenset(exceptions)
         except TypeError:
             raise ConfigurationError(
                 "Filtered or excluded exceptions must be passed as a collection. If using the "
                 "flaky mark, this means `only_on` or `exclude` args must be a collection too."
             )
+        for exception in self.filter:
+            if not (isinstance(exception, type) and issubclass(exception, BaseException)):
+                raise ConfigurationError(
+                    f"Filtered or excluded exceptions must be exception classes, got {exception!r}"
+                )
+
+    def __call__(self, exception_type: Optional[type[BaseException]]) -> bool:
+        return not self.filter or (exception_type in self.filter) is self.list_type
 
     def __bool__(self) -> bool:
         return bool(self.filter)
 
 
+# Filter from the global exception hooks, shared by every item without its own filter.
+# Snapshotted in pytest_configure along with the other defaults above
+default_exception_filter = ExceptionFilter([], [])
+
+
+class CapturedTrace:
+    """A captured traceback, formatted at most once however many attempts it's reported for"""
+
+    __slots__ = ("trace", "formatted")
+
+    def __init__(self, trace: TracebackException) -> None:
+        self.trace = trace
+        self.formatted: Optional[str] = None
+
+    def format(self) -> str:
+        if self.formatted is None:
+            # Stripping first means the indentation pass skips the trailing newlines
+            self.formatted = "".join(self.trace.format()).rstrip().replace("\n", "\n\t")
+        return self.formatted
+
+
 class RetryManager:
     """
     Stores statistics and reports for flaky tests and fixtures which have
     failed at least once during the test session and need to be retried
     """
 
+    __slots__ = ("reporter", "trace_limit", "node_stats", "trace_cache", "pending", "messages")
+
     def __init__(self) -> None:
-        self.reporter: ReportHandler = OfflineReporter()
+        reporter = OfflineReporter()
+        self.reporter: ReportHandler = reporter
         self.trace_limit: Optional[int] = 1
-        self.node_stats: dict[str, dict] = {}
+        self.node_stats: dict[str, tuple[tuple[list, ...], tuple[array, ...]]] = {}
+        self.trace_cache: dict[tuple, CapturedTrace] = {}
+        # Attempts are rendered lazily, so traces are only formatted if a report is written
+        self.pending: deque[tuple[int, str, Optional[CapturedTrace], int]] = deque(
+            maxlen=reporter.chunks.maxlen
+        )
+        # Text either side of the attempt number in each result's message, indexed by result
         self.messages = (
-            " failed on attempt {attempt}! Retrying!\n\t",
-            " failed after {attempt} attempts!\n\t",
-            " teardown failed on attempt {attempt}! Exiting immediately!\n\t",
-            " passed on attempt {attempt}!\n\t",
+            (" failed on attempt ", "! Retrying!\n\t"),
+            (" failed after ", " attempts!\n\t"),
+            (" teardown failed on attempt ", "! Exiting immediately!\n\t"),
+            (" passed on attempt ", "!\n\t"),
         )
 
     def log_attempt(
         self, attempt: int, name: str, exc: Optional[pytest.ExceptionInfo], result: int
     ) -> None:
-        message = self.messages[result].format(attempt=attempt)
-        formatted_trace = ""
-        if exc:
-            err = (exc.type, exc.value, exc.tb)
-            formatted_trace = (
-                formatted_trace.join(format_exception(*err, limit=self.trace_limit))
-                .replace("\n", "\n\t")
-                .rstrip()
+        trace = self.capture_trace(exc) if exc else None
+        if len(self.pending) == self.pending.maxlen:
+            self.reporter.record_omitted(1)
+        self.pending.append((attempt, name, trace, result))
+        # Reporters which can't defer get each item's attempts once its final result is in
+        if not self.reporter.deferred and result != RETRY:
+            self.flush_attempts()
+
+    def capture_trace(self, exc: pytest.ExceptionInfo) -> CapturedTrace:
+        """
+        Capture the traceback without keeping its frames alive. Tests commonly fail the same
+        way on every attempt, so captured traces are shared for as long as the current item is
+        running and each one is only formatted once
+        """
+        key = trace_key(exc)
+        if key is not None and key in self.trace_cache:
+            return self.trace_cache[key]
+        trace = CapturedTrace(
+            TracebackException(
+                exc.type, exc.value, exc.tb, limit=self.trace_limit, lookup_lines=False
             )
-        self.reporter.record_attempt([f"\t{name}", message, formatted_trace, "\n\n"])
+        )
+        if key is not None:
+            self.trace_cache[key] = trace
+        return trace
+
+    def flush_attempts(self) -> None:
+        while self.pending:
+            attempt, name, trace, result = self.pending.popleft()
+            prefix, suffix = self.messages[result]
+            formatted_trace = trace.format() if trace is not None else ""
+            self.reporter.record_attempt(
+                [f"\t{name}", prefix, str(attempt), suffix, formatted_trace, "\n\n"]
+            )
+        self.reporter.flush()
 
     def build_retry_report(self, terminal_reporter: TerminalReporter) -> None:
-        contents = self.reporter.stream.getvalue()
+        self.flush_attempts()
+        contents = self.reporter.contents()
         if not contents:
             return
 
@@ -99,38 +180,67 @@ class RetryManager:
         terminal_reporter.write("\n")
 
     def record_node_stats(self, report: pytest.TestReport) -> None:
-        self.node_stats[report.nodeid]["outcomes"][report.when].append(report.outcome)
-        self.node_stats[report.nodeid]["durations"][report.when].append(report.duration)
+        outcomes, durations = self.node_stats[report.nodeid]
+        i = stage_index[report.when]
+        outcomes[i].append(report.outcome)
+        durations[i].append(report.duration)
 
-    def simple_outcome(self, item: pytest.Item) -> str:
-        """
-        Return failed if setup, teardown, or final call outcome is 'failed'
-        Return skipped if test was skipped
+    def finalize(self, item: pytest.Item) -> tuple[str, float, int]:
         """
-        test_outcomes = self.node_stats[item.nodeid]["outcomes"]
-        for outcome in ("skipped", "failed"):
-            if outcome in test_outcomes["setup"]:
-                return outcome
-        if not test_outcomes["call"] or test_outcomes["call"][-1] == "failed":
-            return "failed"
-        # can probably just simplify this to return test_outcomes["teardown"] as a fallthrough
-        if "failed" in test_outcomes["teardown"]:
-            return "failed"
-        return "passed"
-
-    def simple_duration(self, item: pytest.Item) -> float:
+        Remove the stats for a finished item and return its overall outcome, total duration
+        and number of attempts in a single pass.
+        Outcome is failed if setup, teardown, or final call outcome is 'failed'
+        Outcome is skipped if test was skipped
+        Duration sums setup, teardown, and final call
         """
-        Return total duration for test summing setup, teardown, and final call
-        """
-        return sum(self.node_stats[item.nodeid]["durations"][stage][-1] for stage in stages)
-
-    def sum_attempts(self, item: pytest.Item) -> int:
-        return len(self.node_stats[item.nodeid]["outcomes"]["call"])
+        outcomes, durations = self.node_stats.pop(item.nodeid)
+        setup_outcomes, call_outcomes, teardown_outcomes = outcomes
+        if "skipped" in setup_outcomes:
+            outcome = "skipped"
+        elif (
+            "failed" in setup_outcomes
+            or not call_outcomes
+            or call_outcomes[-1] == "failed"
+            or "failed" in teardown_outcomes
+        ):
+            outcome = "failed"
+        else:
+            outcome = "passed"
+        duration = durations[SETUP][-1] + durations[CALL][-1] + durations[TEARDOWN][-1]
+        return outcome, duration, len(call_outcomes)
 
 
 retry_manager = RetryManager()
 
 
+def trace_key(exc: pytest.ExceptionInfo) -> Optional[tuple]:
+    """
+    Return a key identifying the formatted output of an exception, or None if it can't be
+    cached. Chained exceptions, exception groups and notes all add output which isn't
+    captured by the key, so those are always formatted from scratch
+    """
+    value = exc.value
+    if (
+        value.__cause__ is not None
+        or value.__context__ is not None
+        or getattr(value, "__notes__", None)
+        or getattr(value, "exceptions", None)
+    ):
+        return None
+    try:
+        message = str(value)
+    except Exception:
+        # traceback substitutes a placeholder for a broken __str__, so leave that to it
+        return None
+    key: list = [exc.type, message]
+    tb: Optional[TracebackType] = exc.tb
+    while tb is not None:
+        # The code object and last instruction pin down both the line and the column range
+        key.append((tb.tb_frame.f_code, tb.tb_lasti))
+        tb = tb.tb_next
+    return tuple(key)
+
+
 def has_interactive_exception(call: pytest.CallInfo) -> bool:
     if call.excinfo is None:
         return False
@@ -140,29 +250,21 @@ def has_interactive_exception(call: pytest.CallInfo) -> bool:
     return True
 
 
-def should_handle_retry(call: pytest.CallInfo) -> bool:
-    if call.excinfo is None:
-        return False
-    # if teardown stage, don't retry
-    # may handle fixture setup retries in v2 if requested. For now, this is fine.
-    if call.when in {"setup", "teardown"}:
-        return False
-    # if test was skipped, don't retry
-    if call.excinfo.typename == "Skipped":
-        return False
-    return True
-
-
 @pytest.hookimpl(hookwrapper=True)
 def pytest_runtest_protocol(item: pytest.Item) -> Optional[object]:
-    retry_manager.node_stats[item.nodeid] = {
-        "outcomes": {k: [] for k in stages},
-        "durations": {k: [0.0] for k in stages},
-    }
+    # Outcomes and durations of each stage, indexed by stage_index. Durations are kept
+    # unboxed, they're only ever appended to and summed
+    retry_manager.node_stats[item.nodeid] = (
+        ([], [], []),
+        (array("d", [0.0]), array("d", [0.0]), array("d", [0.0])),
+    )
     yield
-    item.stash[outcome_key] = retry_manager.simple_outcome(item)
-    item.stash[duration_key] = retry_manager.simple_duration(item)  # always overwrite, for now
-    item.stash[attempts_key] = retry_manager.sum_attempts(item)
+    # Everything needed later goes in the item stash, so finalize drops the stats
+    outcome, duration, attempts = retry_manager.finalize(item)
+    item.stash[outcome_key] = outcome
+    item.stash[duration_key] = duration  # always overwrite, for now
+    item.stash[attempts_key] = attempts
+    retry_manager.trace_cache.clear()
 
 
 @pytest.hookimpl(hookwrapper=True, tryfirst=True)
@@ -175,50 +277,74 @@ def pytest_runtest_makereport(
     # Set dynamic outcome for each stage until runtest protocol has completed
     item.stash[outcome_key] = original_report.outcome
 
-    if not should_handle_retry(call):
-        return
+    # Only failed test calls are retried, never setup or teardown failures or skipped tests
+    # (may handle fixture setup retries in v2 if requested. For now, this is fine.)
     # xfail tests don't raise a Skipped exception if they fail, but are still marked as skipped
-    if original_report.skipped is True:
+    if (
+        call.excinfo is None
+        or call.when != "call"
+        or call.excinfo.typename == "Skipped"
+        or original_report.skipped is True
+    ):
         return
 
     flake_mark = item.get_closest_marker("flaky")
     if flake_mark is None:
         return
 
-    condition = flake_mark.kwargs.get("condition")
-    if condition is False:
+    kwargs = flake_mark.kwargs
+    if kwargs.get("condition") is False:
         return
 
-    exception_filter = ExceptionFilter(
-        flake_mark.kwargs.get("only_on", []),
-        flake_mark.kwargs.get("exclude", []),
-    ) or ExceptionFilter(Defaults.FILTERED_EXCEPTIONS, Defaults.EXCLUDED_EXCEPTIONS)
+    # The mark's own filter is only built when it has one, and only once a call has failed,
+    # as marks can still be added during setup
+    if "only_on" in kwargs or "exclude" in kwargs:
+        try:
+            exception_filter = ExceptionFilter(
+                kwargs.get("only_on", []), kwargs.get("exclude", [])
+            ) or default_exception_filter
+        except ConfigurationError as error:
+            # Fail just this item rather than the whole session, the test has already failed
+            original_report.sections.append(
+                ("pytest-retry", f"{type(error).__name__}: {error}")
+            )
+            return
+    else:
+        exception_filter = default_exception_filter
     if not exception_filter(call.excinfo.type):  # type: ignore
         return
 
-    retries = flake_mark.kwargs.get("retries", Defaults.RETRIES)
-    delay = flake_mark.kwargs.get("delay", Defaults.RETRY_DELAY)
-    cumulative_timing = flake_mark.kwargs.get("cumulative_timing", Defaults.CUMULATIVE_TIMING)
+    retries = kwargs.get("retries", default_retries)
+    delay = kwargs.get("delay", default_retry_delay)
+    cumulative_timing = kwargs.get("cumulative_timing", default_cumulative_timing)
     attempts = 1
+    # The fake next item used for preliminary teardowns is reused across the whole session
+    if fake_next_item_key not in item.session.stash:
+        item.session.stash[fake_next_item_key] = pytest.Class.from_parent(
+            item.session, name="Fakeboi"
+        )
+    fake_next_item = item.session.stash[fake_next_item_key]
+    # Resolve the hook callers and bind their arguments once rather than on every attempt
     hook = item.ihook
+    runtest_setup = partial(hook.pytest_runtest_setup, item=item)
+    runtest_call = partial(hook.pytest_runtest_call, item=item)
+    runtest_teardown = partial(hook.pytest_runtest_teardown, item=item, nextitem=fake_next_item)
+    runtest_logreport = hook.pytest_runtest_logreport
+    exception_interact = hook.pytest_exception_interact
+    from_call = pytest.CallInfo.from_call
+    log_attempt = retry_manager.log_attempt
+    record_node_stats = retry_manager.record_node_stats
+    call_durations = retry_manager.node_stats[item.nodeid][1][CALL]
 
     while True:
         # Default teardowns are already excluded, so this must be the `call` stage
         # Try preliminary teardown using a fake class to ensure every local fixture (i.e.
         # excluding session) is torn down. Yes, including module and class fixtures
-        t_call = pytest.CallInfo.from_call(
-            lambda: hook.pytest_runtest_teardown(
-                item=item,
-                nextitem=pytest.Class.from_parent(item.session, name="Fakeboi"),
-            ),
-            when="teardown",
-        )
+        t_call = from_call(runtest_teardown, when="teardown")
         # If teardown fails, break. Flaky teardowns are unacceptable and should raise immediately
         if t_call.excinfo:
             item.stash[outcome_key] = "failed"
-            retry_manager.log_attempt(
-                attempt=attempts, name=item.name, exc=t_call.excinfo, result=EXIT
-            )
+            log_attempt(attempt=attempts, name=item.name, exc=t_call.excinfo, result=EXIT)
             # Prevents a KeyError when an error during retry teardown causes a redundant teardown
             empty: dict[str, list[LogRecord]] = {}
             item.stash[caplog_records_key] = empty
@@ -226,23 +352,24 @@ def pytest_runtest_makereport(
 
         # If teardown passes, send report that the test is being retried
         if attempts == 1:
-            original_report.outcome = Defaults.RETRY_OUTCOME  # type: ignore
-            hook.pytest_runtest_logreport(report=original_report)
+            original_report.outcome = retry_outcome  # type: ignore
+            runtest_logreport(report=original_report)
             original_report.outcome = "failed"
-        retry_manager.log_attempt(attempt=attempts, name=item.name, exc=call.excinfo, result=RETRY)
-        sleep(delay)
+        log_attempt(attempt=attempts, name=item.name, exc=call.excinfo, result=RETRY)
+        if delay:
+            sleep(delay)
         # Calling _initrequest() is required to reset fixtures for a retry. Make public pls?
         item._initrequest()  # type: ignore[attr-defined]
 
-        pytest.CallInfo.from_call(lambda: hook.pytest_runtest_setup(item=item), when="setup")
-        call = pytest.CallInfo.from_call(lambda: hook.pytest_runtest_call(item=item), when="call")
+        from_call(runtest_setup, when="setup")
+        call = from_call(runtest_call, when="call")
         retry_report = pytest.TestReport.from_item_and_call(item, call)
-        retry_manager.record_node_stats(retry_report)
+        record_node_stats(retry_report)
 
         # Do the exception interaction step
         # (may not bother to support this since this is designed for automated runs, not debugging)
         if has_interactive_exception(call):
-            hook.pytest_exception_interact(node=item, call=call, report=retry_report)
+            exception_interact(node=item, call=call, report=retry_report)
 
         attempts += 1
         should_keep_retrying = (
@@ -257,11 +384,9 @@ def pytest_runtest_makereport(
             if cumulative_timing is False:
                 original_report.duration = retry_report.duration
             else:
-                original_report.duration = sum(
-                    retry_manager.node_stats[original_report.nodeid]["durations"]["call"]
-                )
+                original_report.duration = sum(call_durations)
 
-            retry_manager.log_attempt(
+            log_attempt(
                 attempt=attempts,
                 name=item.name,
                 exc=call.excinfo,
@@ -277,8 +402,8 @@ def pytest_terminal_summary(terminalreporter: TerminalReporter) -> None:
 def pytest_report_teststatus(
     report: pytest.TestReport,
 ) -> Optional[tuple[str, str, tuple[str, dict]]]:
-    if report.outcome == Defaults.RETRY_OUTCOME:
-        return Defaults.RETRY_OUTCOME, "R", ("RETRY", {"yellow": True})
+    if report.outcome == retry_outcome:
+        return retry_outcome, "R", ("RETRY", {"yellow": True})
     return None
 
 
@@ -305,6 +430,19 @@ def pytest_configure(config: pytest.Config) -> None:
     Defaults.configure(config)
     Defaults.add("FILTERED_EXCEPTIONS", config.hook.pytest_set_filtered_exceptions() or [])
     Defaults.add("EXCLUDED_EXCEPTIONS", config.hook.pytest_set_excluded_exceptions() or [])
+    global default_retries, default_retry_delay, default_cumulative_timing
+    global default_exception_filter, retry_outcome
+    default_retries = Defaults.RETRIES
+    default_retry_delay = Defaults.RETRY_DELAY
+    default_cumulative_timing = Defaults.CUMULATIVE_TIMING
+    try:
+        default_exception_filter = ExceptionFilter(
+            Defaults.FILTERED_EXCEPTIONS, Defaults.EXCLUDED_EXCEPTIONS
+        )
+    except ConfigurationError as error:
+        # Report bad global hooks as a usage error rather than crashing pytest
+        raise pytest.UsageError(str(error)) from None
+    retry_outcome = Defaults.RETRY_OUTCOME
     if config.pluginmanager.has_plugin("xdist") and config.getoption("numprocesses", False):
         config.pluginmanager.register(XdistHook())
         retry_manager.reporter = ReportServer()
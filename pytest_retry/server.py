@@ -1,27 +1,75 @@
+import os
+import selectors
 import socket
+import struct
 import threading
-from io import StringIO
+from collections import deque
+from operator import itemgetter
+from typing import Optional
+
+# Each batch of reports sent by a worker is prefixed with its length in bytes, the number
+# of attempts it holds and the number of attempts the worker dropped since its last batch
+frame_header = struct.Struct("!III")
+
+
+def max_attempts() -> int:
+    """Number of attempts kept for the retry report, so huge sessions can't grow without limit"""
+    return int(os.environ.get("PYTEST_RETRY_MAX_ATTEMPTS", 100_000))
+
+
+def omitted_note(count: int) -> str:
+    if not count:
+        return ""
+    return f"\t{count} earlier attempt{'' if count == 1 else 's'} omitted\n\n"
 
 
 class ReportHandler:
-    def __init__(self) -> None:
-        self.stream = StringIO()
+    # Whether attempts may be held back and rendered when the final report is built
+    deferred = False
+    # Number of attempts dropped from the report to stay within max_attempts
+    omitted = 0
 
     def record_attempt(self, lines: list[str]) -> None:
         pass
 
+    def record_omitted(self, count: int) -> None:
+        self.omitted += count
+
+    def contents(self) -> str:
+        return ""
+
+    def flush(self) -> None:
+        """Called once every pending attempt has been recorded"""
+        pass
+
 
 class OfflineReporter(ReportHandler):
+    deferred = True
+
     def __init__(self) -> None:
         super().__init__()
+        self.chunks: deque[str] = deque(maxlen=max_attempts())
 
     def record_attempt(self, lines: list[str]) -> None:
-        self.stream.writelines(lines)
+        if len(self.chunks) == self.chunks.maxlen:
+            self.omitted += 1
+        self.chunks.append("".join(lines))
+
+    def contents(self) -> str:
+        return omitted_note(self.omitted) + "".join(self.chunks)
 
 
 class ReportServer(ReportHandler):
     def __init__(self) -> None:
         super().__init__()
+        # Complete batches as (connection index, attempts, raw report bytes), in the order
+        # they arrived. The oldest are dropped once there are more than max_attempts, and
+        # the rest are only decoded once the final report is built
+        self.batches: deque[tuple[int, int, bytes]] = deque()
+        self.attempts = 0
+        self.max_attempts = max_attempts()
+        self.connections = 0
+        self.lock = threading.Lock()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setblocking(True)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -36,31 +84,95 @@ class ReportServer(ReportHandler):
         return self.sock.getsockname()[-1]
 
     def run_server(self) -> None:
+        """
+        Serve every worker connection at once, so that one worker's reports can't hold up
+        the others. Each connection gets its own buffer, and incoming bytes are held back
+        until the batch they belong to has fully arrived
+        """
         self.sock.listen()
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        buffer = bytearray(65536)
+        view = memoryview(buffer)
         while True:
-            conn, _ = self.sock.accept()
-
-            with conn:
-                while True:
-                    chunk = conn.recv(4096)
-                    if not chunk:
+            for key, _ in selector.select():
+                if key.fileobj is self.sock:
+                    conn, _ = self.sock.accept()
+                    selector.register(
+                        conn, selectors.EVENT_READ, (conn, self.connections, bytearray())
+                    )
+                    self.connections += 1
+                    continue
+
+                conn, index, partial = key.data
+                size = conn.recv_into(buffer)
+                if not size:
+                    selector.unregister(conn)
+                    conn.close()
+                    continue
+                partial += view[:size]
+                start = 0
+                while len(partial) - start >= frame_header.size:
+                    length, attempts, omitted = frame_header.unpack_from(partial, start)
+                    end = start + frame_header.size + length
+                    if end > len(partial):
                         break
-                    self.stream.write(chunk.decode("utf-8"))
+                    raw = bytes(partial[start + frame_header.size : end])
+                    self.record_batch(index, attempts, omitted, raw)
+                    start = end
+                del partial[:start]
+
+    def record_batch(self, index: int, attempts: int, omitted: int, raw: bytes) -> None:
+        with self.lock:
+            self.batches.append((index, attempts, raw))
+            self.attempts += attempts
+            self.omitted += omitted
+            while self.attempts > self.max_attempts:
+                _, dropped, _ = self.batches.popleft()
+                self.attempts -= dropped
+                self.omitted += dropped
+
+    def contents(self) -> str:
+        with self.lock:
+            # Grouped by connection so each worker's reports are kept together
+            batches = sorted(self.batches, key=itemgetter(0))
+            omitted = self.omitted
+        return omitted_note(omitted) + b"".join(raw for _, _, raw in batches).decode("utf-8")
 
 
 class ClientReporter(ReportHandler):
     def __init__(self, port: int) -> None:
         super().__init__()
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setblocking(True)
-        self.sock.connect(("localhost", port))
+        # Reports are encoded as they're recorded and sent as one batch for each item
+        self.buffer = bytearray()
+        self.attempts = 0
+        self.port = port
+        # Most workers never retry anything, so they only connect once there's a report to send
+        self.sock: Optional[socket.socket] = None
 
     def __del__(self) -> None:
-        self.sock.close()
+        if self.sock is not None:
+            self.sock.close()
+
+    def connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(True)
+        # Each batch is sent with a single sendall, so there's nothing for Nagle to coalesce
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.connect(("localhost", self.port))
+        self.sock = sock
+        return sock
 
     def record_attempt(self, lines: list[str]) -> None:
-        self.stream.writelines(lines)
-        # Group reports for each item together before sending and resetting stream
-        if not lines[1].endswith("Retrying!\n\t"):
-            self.sock.sendall(self.stream.getvalue().encode("utf-8"))
-            self.stream = StringIO()
+        for line in lines:
+            self.buffer += line.encode("utf-8")
+        self.attempts += 1
+
+    def flush(self) -> None:
+        if self.buffer or self.omitted:
+            sock = self.sock or self.connect()
+            header = frame_header.pack(len(self.buffer), self.attempts, self.omitted)
+            sock.sendall(header + self.buffer)
+            del self.buffer[:]
+            self.attempts = 0
+            self.omitted = 0
@@ -1,26 +1,87 @@
-from pytest import mark
+import json
+from importlib.util import find_spec
+from pytest import ExitCode, mark
 
-try:
-    from xdist import __version__  # noqa: F401
-
-    xdist_installed = True
-except ImportError:
-    xdist_installed = False
-
-pytest_plugins = ["pytester"]
+# Checked without importing xdist, so collecting this module never pays for the import
+xdist_installed = find_spec("xdist") is not None
 
 xdist_test_marker = mark.skipif(
     not xdist_installed,
     reason="Only run if xdist is installed locally"
 )
+# Tests which start their own xdist workers share one outer worker under --dist loadgroup
+nested_xdist_group = mark.xdist_group("nested_xdist")
 
 
-def check_outcome_field(outcomes, field_name, expected_value):
-    field_value = outcomes.get(field_name, 0)
-    assert field_value == expected_value, (
-        f"outcomes.{field_name} has unexpected value. "
-        f"Expected '{expected_value}' but got '{field_value}'"
-    )
+# Runs the inner session on a virtual clock. pytest times each stage through _pytest.timing,
+# which is patched for the inner session only, so tests which take the `sleep` fixture
+# advance the clock instead of waiting. The plugin's retry delay does the same, and each
+# delay is also recorded in delays.txt
+virtual_clock_conftest = """
+    import json
+    import pytest
+    from _pytest import timing
+    from pytest_retry import retry_plugin
+
+    now = [0.0]
+    delays = []
+    patches = pytest.MonkeyPatch()
+
+    def advance(seconds):
+        now[0] += seconds
+
+    def retry_delay(seconds):
+        delays.append(seconds)
+        advance(seconds)
+
+    @pytest.fixture
+    def sleep():
+        return advance
+
+    def pytest_configure(config):
+        patches.setattr(timing, "perf_counter", lambda: now[0])
+        patches.setattr(retry_plugin, "sleep", retry_delay)
+
+    def pytest_unconfigure(config):
+        patches.undo()
+        config.rootpath.joinpath("delays.txt").write_text(json.dumps(delays))
+    """
+
+
+def eventually_passes(failures):
+    """Source for a single test which fails on its first `failures` attempts"""
+    return f"""
+    a = []
+    def test_eventually_passes():
+        a.append(1)
+        assert len(a) > {failures}
+    """
+
+
+# Records the stash values of every item in stash.json once the session finishes
+stash_conftest = """
+    import json
+    from pytest_retry import attempts_key, duration_key, outcome_key
+
+    def pytest_sessionfinish(session):
+        stash = {
+            item.name: {
+                "outcome": item.stash[outcome_key],
+                "attempts": item.stash[attempts_key],
+                "duration": item.stash[duration_key],
+            }
+            for item in session.items
+        }
+        session.config.rootpath.joinpath("stash.json").write_text(json.dumps(stash))
+    """
+
+
+def recorded_delays(pytester):
+    return json.loads(pytester.path.joinpath("delays.txt").read_text())
+
+
+def recorded_stash(pytester, name="test_success"):
+    return json.loads(pytester.path.joinpath("stash.json").read_text())[name]
 
 
 def assert_outcomes(
@@ -33,131 +94,87 @@ def assert_outcomes(
     xpassed=0,
     retried=0,
 ):
+    expected = {
+        "passed": passed,
+        "skipped": skipped,
+        "failed": failed,
+        "errors": errors,
+        "xfailed": xfailed,
+        "xpassed": xpassed,
+        "retried": retried,
+    }
     outcomes = result.parseoutcomes()
-    check_outcome_field(outcomes, "passed", passed)
-    check_outcome_field(outcomes, "skipped", skipped)
-    check_outcome_field(outcomes, "failed", failed)
-    check_outcome_field(outcomes, "errors", errors)
-    check_outcome_field(outcomes, "xfailed", xfailed)
-    check_outcome_field(outcomes, "xpassed", xpassed)
-    check_outcome_field(outcomes, "retried", retried)
+    assert {field: outcomes.get(field, 0) for field in expected} == expected
 
 
-def test_no_retry_on_pass(testdir):
-    testdir.makepyfile("def test_success(): assert 1 == 1")
-    result = testdir.runpytest("--retries", "1")
+@mark.parametrize(
+    "source, expected",
+    [
+        ("def test_success(): assert 1 == 1", {}),
+        ("def test_fail(): assert False", {"passed": 0, "failed": 1, "retried": 1}),
+        (eventually_passes(1), {"passed": 1, "retried": 1}),
+    ],
+    ids=["pass", "consistent_failure", "temporary_failure"],
+)
+def test_retries_from_command_line(pytester, source, expected):
+    pytester.makepyfile(source)
+    result = pytester.runpytest("--retries", "1")
 
-    assert_outcomes(result)
+    assert_outcomes(result, **expected)
 
 
-def test_no_retry_on_fail_without_plugin(testdir):
-    testdir.makepyfile("def test_failure(): assert False")
-    result = testdir.runpytest()
+def test_no_retry_on_fail_without_plugin(pytester):
+    pytester.makepyfile("def test_failure(): assert False")
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=0, failed=1, retried=0)
 
 
-def test_no_retry_on_skip_mark(testdir):
-    testdir.makepyfile(
+def test_no_retry_on_skip_or_xfail(pytester):
+    pytester.makepyfile(
         """
         import pytest
+
         @pytest.mark.skip(reason="do not run me")
-        def test_skip():
+        def test_skip_mark():
             assert 1 == 1
-        """
-    )
-    result = testdir.runpytest("--retries", "1")
 
-    assert_outcomes(result, passed=0, skipped=1)
-
-
-def test_no_retry_on_skip_call(testdir):
-    testdir.makepyfile(
-        """
-        import pytest
-        def test_skip():
+        def test_skip_call():
             pytest.skip(reason="Don't test me")
-        """
-    )
-    result = testdir.runpytest("--retries", "1")
 
-    assert_outcomes(result, passed=0, skipped=1)
-
-
-def test_no_retry_on_xfail_mark(testdir):
-    testdir.makepyfile(
-        """
-        import pytest
         @pytest.mark.xfail()
         def test_xfail():
             assert False
-        """
-    )
-    result = testdir.runpytest("--retries", "1")
-
-    assert_outcomes(result, passed=0, xfailed=1, failed=0)
 
-
-def test_no_retry_on_xpass(testdir):
-    testdir.makepyfile(
-        """
-        import pytest
         @pytest.mark.xfail()
         def test_xpass():
             assert 1 == 1
-        """
-    )
-    result = testdir.runpytest("--retries", "1")
-
-    assert_outcomes(result, passed=0, xpassed=1, failed=0)
 
-
-def test_no_retry_on_strict_xpass(testdir):
-    testdir.makepyfile(
-        """
-        import pytest
         @pytest.mark.xfail(strict=True)
-        def test_xpass():
+        def test_strict_xpass():
             assert 1 == 1
         """
     )
-    result = testdir.runpytest("--retries", "1")
+    result = pytester.runpytest("--retries", "1")
 
-    assert_outcomes(result, passed=0, xpassed=0, failed=1)
+    assert_outcomes(result, passed=0, skipped=2, xfailed=1, xpassed=1, failed=1)
 
 
-def test_retry_fails_after_consistent_setup_failure(testdir):
-    testdir.makepyfile("def test_pass(): pass")
-    testdir.makeconftest(
+def test_retry_fails_after_consistent_setup_failure(pytester):
+    pytester.makepyfile("def test_pass(): pass")
+    pytester.makeconftest(
         """
         def pytest_runtest_setup(item):
             raise Exception("Setup failure")
         """
     )
-    result = testdir.runpytest("--retries", "1")
+    result = pytester.runpytest("--retries", "1")
 
     assert_outcomes(result, passed=0, errors=1, retried=0)
 
 
-@mark.skip(reason="Not worrying about setup failures for now, maybe later")
-def test_retry_passes_after_temporary_setup_failure(testdir):
-    testdir.makepyfile("def test_pass(): pass")
-    testdir.makeconftest(
-        """
-        a = []
-        def pytest_runtest_setup(item):
-            a.append(1)
-            if len(a) < 2:
-                raise ValueError("Setup failed!")
-        """
-    )
-    result = testdir.runpytest("--retries", "1")
-
-    assert_outcomes(result, passed=1, retried=1)
-
-
-def test_retry_exits_immediately_on_teardown_failure(testdir):
-    testdir.makepyfile(
+def test_retry_exits_immediately_on_teardown_failure(pytester):
+    pytester.makepyfile(
         """
         import pytest
 
@@ -172,42 +189,14 @@ def test_retry_exits_immediately_on_teardown_failure(testdir):
             assert len(a) > 1
         """
     )
-    result = testdir.runpytest("--retries", "1")
+    result = pytester.runpytest("--retries", "1")
 
     assert_outcomes(result, passed=0, failed=1, retried=0)
 
 
-def test_retry_fails_after_consistent_test_failure(testdir):
-    testdir.makepyfile("def test_fail(): assert False")
-    result = testdir.runpytest("--retries", "1")
-
-    assert_outcomes(result, passed=0, failed=1, retried=1)
-
-
-def test_retry_passes_after_temporary_test_failure(testdir):
-    testdir.makepyfile(
-        """
-        a = []
-        def test_eventually_passes():
-            a.append(1)
-            assert len(a) > 1
-        """
-    )
-    result = testdir.runpytest("--retries", "1")
-
-    assert_outcomes(result, passed=1, retried=1)
-
-
-def test_custom_retry_outcome_for_reporting_compatibility(testdir):
-    testdir.makepyfile(
-        """
-        a = []
-        def test_eventually_passes():
-            a.append(1)
-            assert len(a) > 1
-        """
-    )
-    result = testdir.runpytest("--retries", "1", "--retry-outcome", "redo")
+def test_custom_retry_outcome_for_reporting_compatibility(pytester):
+    pytester.makepyfile(eventually_passes(1))
+    result = pytester.runpytest("--retries", "1", "--retry-outcome", "redo")
 
     outcomes = result.parseoutcomes()
     assert outcomes['passed'] == 1
@@ -215,8 +204,8 @@ def test_custom_retry_outcome_for_reporting_compatibility(testdir):
     assert outcomes.get('retried', None) is None
 
 
-def test_retry_passes_after_temporary_test_failure_with_flaky_mark(testdir):
-    testdir.makepyfile(
+def test_retry_passes_after_temporary_test_failure_with_flaky_mark(pytester):
+    pytester.makepyfile(
         """
         import pytest
 
@@ -228,13 +217,13 @@ def test_retry_passes_after_temporary_test_failure_with_flaky_mark(testdir):
             assert len(a) > 2
         """
     )
-    result = testdir.runpytest()
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=1, retried=1)
 
 
-def test_retries_if_flaky_mark_is_applied_without_options(testdir):
-    testdir.makepyfile(
+def test_retries_if_flaky_mark_is_applied_without_options(pytester):
+    pytester.makepyfile(
         """
         import pytest
 
@@ -246,77 +235,66 @@ def test_retries_if_flaky_mark_is_applied_without_options(testdir):
             assert len(a) > 1
         """
     )
-    result = testdir.runpytest()
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=1, retried=1)
 
 
-def test_fixtures_are_retried_with_test(testdir):
-    testdir.makepyfile(
+def test_retries_if_flaky_mark_is_applied_by_fixture(pytester):
+    pytester.makepyfile(
         """
         import pytest
 
         a = []
-        setup = []
-        teardown = []
 
-        @pytest.fixture()
-        def basic_setup_and_teardown():
-            setup.append(True)
-            yield
-            teardown.append(True)
+        @pytest.fixture
+        def flaky(request):
+            request.applymarker(pytest.mark.flaky(retries=2))
 
-        @pytest.mark.flaky(retries=2)
-        def test_eventually_passes(basic_setup_and_teardown):
+        def test_eventually_passes(flaky):
             a.append(1)
             assert len(a) > 2
-
-
-        def test_setup_and_teardown_reran():
-            assert len(setup) == 3
-            assert len(teardown) == 3
         """
     )
-    result = testdir.runpytest()
+    result = pytester.runpytest()
 
-    assert_outcomes(result, passed=2, failed=0, retried=1)
+    assert_outcomes(result, passed=1, retried=1)
 
 
-def test_retry_executes_class_scoped_fixture(testdir):
-    testdir.makepyfile(
-        """
+@mark.parametrize("scope, teardowns", [("function", 3), ("module", 2)])
+def test_fixtures_are_retried_with_test(pytester, scope, teardowns):
+    pytester.makepyfile(
+        f"""
         import pytest
 
         a = []
         setup = []
         teardown = []
 
-        @pytest.fixture(scope="class")
+        @pytest.fixture(scope="{scope}")
         def basic_setup_and_teardown():
             setup.append(True)
             yield
             teardown.append(True)
 
-        @pytest.mark.usefixtures("basic_setup_and_teardown")
-        class TestClassFixtures:
-            @pytest.mark.flaky(retries=2)
-            def test_eventually_passes(self):
-                a.append(1)
-                assert len(a) > 2
+        @pytest.mark.flaky(retries=2)
+        def test_eventually_passes(basic_setup_and_teardown):
+            a.append(1)
+            assert len(a) > 2
 
 
         def test_setup_and_teardown_reran():
             assert len(setup) == 3
-            assert len(teardown) == 3
+            assert len(teardown) == {teardowns}
         """
     )
-    result = testdir.runpytest()
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=2, failed=0, retried=1)
 
 
-def test_retry_executes_module_scoped_fixture(testdir):
-    testdir.makepyfile(
+def test_retry_executes_class_scoped_fixture(pytester):
+    pytester.makepyfile(
         """
         import pytest
 
@@ -324,44 +302,39 @@ def test_retry_executes_module_scoped_fixture(testdir):
         setup = []
         teardown = []
 
-        @pytest.fixture(scope="module")
+        @pytest.fixture(scope="class")
         def basic_setup_and_teardown():
             setup.append(True)
             yield
             teardown.append(True)
 
-        @pytest.mark.flaky(retries=2)
-        def test_eventually_passes(basic_setup_and_teardown):
-            a.append(1)
-            assert len(a) > 2
+        @pytest.mark.usefixtures("basic_setup_and_teardown")
+        class TestClassFixtures:
+            @pytest.mark.flaky(retries=2)
+            def test_eventually_passes(self):
+                a.append(1)
+                assert len(a) > 2
 
 
         def test_setup_and_teardown_reran():
             assert len(setup) == 3
-            assert len(teardown) == 2
+            assert len(teardown) == 3
         """
     )
-    result = testdir.runpytest()
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=2, failed=0, retried=1)
 
 
-def test_retry_fails_if_temporary_failures_exceed_retry_limit(testdir):
-    testdir.makepyfile(
-        """
-        a = []
-        def test_eventually_passes():
-            a.append(1)
-            assert len(a) > 3
-        """
-    )
-    result = testdir.runpytest("--retries", "2")
+def test_retry_fails_if_temporary_failures_exceed_retry_limit(pytester):
+    pytester.makepyfile(eventually_passes(3))
+    result = pytester.runpytest("--retries", "2")
 
     assert_outcomes(result, passed=0, failed=1, retried=1)
 
 
-def test_retry_delay_from_mark_between_attempts(testdir):
-    testdir.makepyfile(
+def test_retry_delay_from_mark_between_attempts(pytester):
+    pytester.makepyfile(
         """
         import pytest
 
@@ -373,34 +346,34 @@ def test_retry_delay_from_mark_between_attempts(testdir):
             assert len(a) > 2
         """
     )
-    result = testdir.runpytest()
+    pytester.makeconftest(virtual_clock_conftest)
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=1, retried=1)
-    assert result.duration > 4
+    assert recorded_delays(pytester) == [2, 2]
 
 
-def test_retry_delay_from_command_line_between_attempts(testdir):
-    testdir.makepyfile(
-        """
-        import pytest
+def test_retry_delay_from_command_line_between_attempts(pytester):
+    pytester.makepyfile(eventually_passes(2))
+    pytester.makeconftest(virtual_clock_conftest)
+    result = pytester.runpytest("--retries", "2", "--retry-delay", "0.2")
 
-        a = []
+    assert_outcomes(result, passed=1, retried=1)
+    assert recorded_delays(pytester) == [0.2, 0.2]
 
-        def test_eventually_passes():
-            a.append(1)
-            assert len(a) > 2
-        """
-    )
-    result = testdir.runpytest("--retries", "2", "--retry-delay", "0.2")
+
+@mark.slow
+def test_retry_delay_waits_in_real_time(pytester):
+    pytester.makepyfile(eventually_passes(2))
+    result = pytester.runpytest("--retries", "2", "--retry-delay", "0.2")
 
     assert_outcomes(result, passed=1, retried=1)
     assert result.duration > 0.4
-    assert result.duration < 0.8
 
 
-def test_passing_outcome_is_available_from_item_stash(testdir):
-    testdir.makepyfile("def test_success(): assert 1 == 1")
-    testdir.makeconftest(
+def test_passing_outcome_is_available_from_item_stash(pytester):
+    pytester.makepyfile("def test_success(): assert 1 == 1")
+    pytester.makeconftest(
         """
         import pytest
         from pytest_retry import outcome_key
@@ -411,31 +384,32 @@ def test_passing_outcome_is_available_from_item_stash(testdir):
             assert request.node.stash[outcome_key] == "passed"
         """
     )
-    result = testdir.runpytest()
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=1)
 
 
-def test_failed_outcome_is_available_from_item_stash(testdir):
-    testdir.makepyfile("def test_success(): assert 1 == 2")
-    testdir.makeconftest(
-        """
-        import pytest
-        from pytest_retry import outcome_key
+def test_failed_outcome_is_available_from_item_stash(pytester):
+    pytester.makepyfile("def test_success(): assert 1 == 2")
+    pytester.makeconftest(
+        stash_conftest
+        + """
+    import pytest
 
-        @pytest.fixture(autouse=True)
-        def report_check(request):
-            yield
-            assert request.node.stash[outcome_key] == "failed"
-        """
+    @pytest.fixture(autouse=True)
+    def report_check(request):
+        yield
+        assert request.node.stash[outcome_key] == "failed"
+    """
     )
-    result = testdir.runpytest()
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=0, failed=1)
+    assert recorded_stash(pytester)["outcome"] == "failed"
 
 
-def test_skipped_outcome_is_available_from_item_stash(testdir):
-    testdir.makepyfile(
+def test_skipped_outcome_is_available_from_item_stash(pytester):
+    pytester.makepyfile(
         """
         import pytest
 
@@ -443,296 +417,226 @@ def test_skipped_outcome_is_available_from_item_stash(testdir):
         def test_success(): assert 1 == 2
         """
     )
-    testdir.makeconftest(
-        """
-        import pytest
-        from pytest_retry import outcome_key, attempts_key, duration_key
-
-        def pytest_sessionfinish(session: pytest.Session) -> None:
-            for item in session.items:
-                assert item.stash[outcome_key] == "skipped"
-                assert item.stash[attempts_key] == 0
-                assert item.stash[duration_key] < 0.1
-        """
-    )
-    result = testdir.runpytest()
+    pytester.makeconftest(stash_conftest)
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=0, skipped=1)
+    stash = recorded_stash(pytester)
+    assert stash["outcome"] == "skipped"
+    assert stash["attempts"] == 0
+    assert stash["duration"] < 0.1
 
 
-def test_duration_is_available_from_item_stash(testdir):
-    testdir.makepyfile("""def test_success(): assert 1 == 1""")
-    testdir.makeconftest(
-        """
-        import pytest
-        from pytest_retry import duration_key
-
-        def pytest_sessionfinish(session: pytest.Session) -> None:
-            for item in session.items:
-                assert item.stash[duration_key] > 0
-        """
-    )
-    result = testdir.runpytest()
+def test_duration_is_available_from_item_stash(pytester):
+    pytester.makepyfile("""def test_success(): assert 1 == 1""")
+    pytester.makeconftest(stash_conftest)
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=1)
+    assert recorded_stash(pytester)["duration"] > 0
 
 
-def test_failed_outcome_after_successful_teardown(testdir):
-    testdir.makepyfile("def test_success(): assert 1 == 2")
-    testdir.makeconftest(
-        """
-        import pytest
-        from pytest_retry import outcome_key
+def test_failed_outcome_after_unsuccessful_setup(pytester):
+    pytester.makepyfile("def test_success(): assert 1 == 1")
+    pytester.makeconftest(
+        stash_conftest
+        + """
+    import pytest
 
-        @pytest.fixture(autouse=True)
-        def successful_teardown(request):
-            yield
-            assert 1 == 1
-
-        def pytest_sessionfinish(session: pytest.Session) -> None:
-            for item in session.items:
-                assert item.stash[outcome_key] == "failed"
-        """
+    @pytest.fixture(autouse=True)
+    def failed_setup(request):
+        assert 1 == 2
+    """
     )
-    result = testdir.runpytest()
-
-    assert_outcomes(result, passed=0, failed=1)
-
-
-def test_failed_outcome_after_unsuccessful_setup(testdir):
-    testdir.makepyfile("def test_success(): assert 1 == 1")
-    testdir.makeconftest(
-        """
-        import pytest
-        from pytest_retry import outcome_key
-
-        @pytest.fixture(autouse=True)
-        def failed_setup(request):
-            assert 1 == 2
-
-        def pytest_sessionfinish(session: pytest.Session) -> None:
-            for item in session.items:
-                assert item.stash[outcome_key] == "failed"
-        """
-    )
-    result = testdir.runpytest()
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=0, errors=1)
+    assert recorded_stash(pytester)["outcome"] == "failed"
 
 
-def test_failed_outcome_after_unsuccessful_teardown(testdir):
-    testdir.makepyfile("def test_success(): assert 1 == 1")
-    testdir.makeconftest(
-        """
-        import pytest
-        from pytest_retry import outcome_key
-
-        @pytest.fixture(autouse=True)
-        def failed_teardown(request):
-            yield
-            assert 1 == 2
+def test_failed_outcome_after_unsuccessful_teardown(pytester):
+    pytester.makepyfile("def test_success(): assert 1 == 1")
+    pytester.makeconftest(
+        stash_conftest
+        + """
+    import pytest
 
-        def pytest_sessionfinish(session: pytest.Session) -> None:
-            for item in session.items:
-                assert item.stash[outcome_key] == "failed"
-        """
+    @pytest.fixture(autouse=True)
+    def failed_teardown(request):
+        yield
+        assert 1 == 2
+    """
     )
-    result = testdir.runpytest()
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=1, errors=1)
+    assert recorded_stash(pytester)["outcome"] == "failed"
 
 
-def test_attempts_are_always_available_from_item_stash(testdir):
-    testdir.makepyfile("def test_success(): assert 1 == 1")
-    testdir.makeconftest(
-        """
-        import pytest
-        from pytest_retry import attempts_key
-
-        def pytest_sessionfinish(session: pytest.Session) -> None:
-            for item in session.items:
-                assert item.stash[attempts_key] == 1
-        """
-    )
-    result = testdir.runpytest()
+def test_attempts_are_always_available_from_item_stash(pytester):
+    pytester.makepyfile("def test_success(): assert 1 == 1")
+    pytester.makeconftest(stash_conftest)
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=1)
-
-
-def test_global_filtered_exception_is_retried(testdir):
-    testdir.makepyfile(
-        """
+    assert recorded_stash(pytester)["attempts"] == 1
+
+
+@mark.parametrize(
+    "hook, listed, raised, failures, retries, expected",
+    [
+        ("filtered", "AssertionError", "AssertionError", 1, 1, {"passed": 1, "retried": 1}),
+        ("filtered", "IndexError", "IndexError", 4, 3, {"passed": 0, "failed": 1, "retried": 1}),
+        ("filtered", "IndexError", "ValueError", 1, 1, {"passed": 0, "failed": 1}),
+        ("excluded", "AssertionError", "ValueError", 1, 1, {"passed": 1, "retried": 1}),
+        (
+            "excluded",
+            "AssertionError",
+            "ValueError",
+            4,
+            3,
+            {"passed": 0, "failed": 1, "retried": 1},
+        ),
+        ("excluded", "ValueError", "ValueError", 1, 1, {"passed": 0, "failed": 1}),
+    ],
+    ids=[
+        "filtered_exception_is_retried",
+        "filtered_exception_fails_when_attempts_exceeded",
+        "exception_is_not_retried_if_filter_not_matched",
+        "exception_is_retried_if_not_excluded",
+        "exception_fails_if_not_excluded_and_attempts_exceeded",
+        "exception_is_not_retried_if_excluded",
+    ],
+)
+def test_global_exception_filters(pytester, hook, listed, raised, failures, retries, expected):
+    pytester.makepyfile(
+        f"""
         a = []
         def test_eventually_passes():
             a.append(1)
-            if not len(a) > 1:
-                raise AssertionError
+            if not len(a) > {failures}:
+                raise {raised}
         """
     )
-    testdir.makeconftest(
-        """
-        import pytest
-
-        def pytest_set_filtered_exceptions():
-            return [AssertionError]
-
+    pytester.makeconftest(
+        f"""
+        def pytest_set_{hook}_exceptions():
+            return [{listed}]
         """
     )
-    result = testdir.runpytest("--retries", "1")
+    result = pytester.runpytest("--retries", str(retries))
 
-    assert_outcomes(result, passed=1, retried=1)
+    assert_outcomes(result, **expected)
 
 
-def test_temporary_filtered_exception_fails_when_attempts_exceeded(testdir):
-    testdir.makepyfile(
+def test_global_exception_filters_are_exclusive(pytester):
+    pytester.makepyfile("def test_success(): pass")
+    pytester.makeconftest(
         """
-        a = []
-        def test_eventually_passes():
-            a.append(1)
-            if not len(a) > 4:
-                raise IndexError
-        """
-    )
-    testdir.makeconftest(
-        """
-        import pytest
-
         def pytest_set_filtered_exceptions():
-            return [IndexError]
+            return [ValueError]
 
+        def pytest_set_excluded_exceptions():
+            return [KeyError]
         """
     )
-    result = testdir.runpytest("--retries", "3")
+    result = pytester.runpytest()
 
-    assert_outcomes(result, passed=0, failed=1, retried=1)
+    assert result.ret == ExitCode.USAGE_ERROR
+    assert any("are exclusive and cannot be defined simultaneously" in line
+               for line in result.errlines)
 
 
-def test_temporary_exception_is_not_retried_if_filter_not_matched(testdir):
-    testdir.makepyfile(
-        """
-        a = []
-        def test_eventually_passes():
-            a.append(1)
-            if not len(a) > 1:
-                raise ValueError
-        """
-    )
-    testdir.makeconftest(
+def test_flaky_mark_exception_filter_param_overrides_global_filter(pytester):
+    pytester.makepyfile(
         """
         import pytest
 
-        def pytest_set_filtered_exceptions():
-            return [IndexError]
-
-        """
-    )
-    result = testdir.runpytest("--retries", "1")
-
-    assert_outcomes(result, passed=0, failed=1, retried=0)
-
-
-def test_temporary_exception_is_retried_if_not_globally_excluded(testdir):
-    testdir.makepyfile(
-        """
         a = []
+
+        @pytest.mark.flaky(only_on=[IndexError])
         def test_eventually_passes():
             a.append(1)
             if not len(a) > 1:
                 raise ValueError
         """
     )
-    testdir.makeconftest(
+    pytester.makeconftest(
         """
         import pytest
 
         def pytest_set_excluded_exceptions():
-            return [AssertionError]
+            return [IndexError]
 
         """
     )
-    result = testdir.runpytest("--retries", "1")
+    result = pytester.runpytest("--retries", "1")
 
-    assert_outcomes(result, passed=1, retried=1)
+    assert_outcomes(result, passed=0, failed=1, retried=0)
 
 
-def test_temporary_exception_fails_if_not_excluded_and_attempts_exceeded(testdir):
-    testdir.makepyfile(
-        """
-        a = []
-        def test_eventually_passes():
-            a.append(1)
-            if not len(a) > 4:
-                raise ValueError
-        """
-    )
-    testdir.makeconftest(
+def test_flaky_mark_exception_filter_must_be_a_collection(pytester):
+    pytester.makepyfile(
         """
         import pytest
 
-        def pytest_set_excluded_exceptions():
-            return [AssertionError]
-
+        @pytest.mark.flaky(only_on=ValueError)
+        def test_bad_filter():
+            raise ValueError
         """
     )
-    result = testdir.runpytest("--retries", "3")
+    result = pytester.runpytest()
 
-    assert_outcomes(result, passed=0, failed=1, retried=1)
+    assert_outcomes(result, passed=0, failed=1)
+    message = "ConfigurationError: Filtered or excluded exceptions must be passed as a collection"
+    assert any(message in line for line in result.outlines)
 
 
-def test_temporary_exception_is_not_retried_if_excluded(testdir):
-    testdir.makepyfile(
-        """
-        a = []
-        def test_eventually_passes():
-            a.append(1)
-            if not len(a) > 1:
-                raise ValueError
-        """
-    )
-    testdir.makeconftest(
-        """
+@mark.parametrize(
+    "only_on, message",
+    [
+        ('"ValueError"', "must be passed as a collection"),
+        ('[ValueError, "KeyError"]', "must be exception classes, got 'KeyError'"),
+    ],
+    ids=["string", "not_an_exception"],
+)
+def test_flaky_mark_exception_filter_must_contain_exception_classes(pytester, only_on, message):
+    pytester.makepyfile(
+        f"""
         import pytest
 
-        def pytest_set_excluded_exceptions():
-            return [ValueError]
-
+        @pytest.mark.flaky(only_on={only_on})
+        def test_bad_filter():
+            raise ValueError
         """
     )
-    result = testdir.runpytest("--retries", "1")
+    result = pytester.runpytest()
 
-    assert_outcomes(result, passed=0, failed=1, retried=0)
-
-
-def test_flaky_mark_exception_filter_param_overrides_global_filter(testdir):
-    testdir.makepyfile(
-        """
-        import pytest
+    assert_outcomes(result, passed=0, failed=1)
+    assert any(f"ConfigurationError: Filtered or excluded exceptions {message}" in line
+               for line in result.outlines)
 
-        a = []
 
-        @pytest.mark.flaky(only_on=[IndexError])
-        def test_eventually_passes():
-            a.append(1)
-            if not len(a) > 1:
-                raise ValueError
-        """
-    )
-    testdir.makeconftest(
+def test_invalid_exception_filter_does_not_affect_passing_tests(pytester):
+    pytester.makepyfile(
         """
         import pytest
 
-        def pytest_set_excluded_exceptions():
-            return [IndexError]
+        @pytest.mark.flaky(only_on=ValueError)
+        def test_bad_filter():
+            pass
 
+        def test_success():
+            pass
         """
     )
-    result = testdir.runpytest("--retries", "1")
+    result = pytester.runpytest()
 
-    assert_outcomes(result, passed=0, failed=1, retried=0)
+    assert_outcomes(result, passed=2)
 
 
-def test_attempt_count_is_correct(testdir):
-    testdir.makepyfile(
+def test_attempt_count_is_correct(pytester):
+    pytester.makepyfile(
         """
         import pytest
 
@@ -744,7 +648,7 @@ def test_attempt_count_is_correct(testdir):
             assert len(a) > 2
         """
     )
-    testdir.makeconftest(
+    pytester.makeconftest(
         """
         import pytest
         from pytest_retry import attempts_key
@@ -754,13 +658,13 @@ def test_attempt_count_is_correct(testdir):
                 assert item.stash[attempts_key] == 3
         """
     )
-    result = testdir.runpytest()
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=1, retried=1)
 
 
-def test_flaky_mark_overrides_command_line_options(testdir):
-    testdir.makepyfile(
+def test_flaky_mark_overrides_command_line_options(pytester):
+    pytester.makepyfile(
         """
         import pytest
 
@@ -777,28 +681,27 @@ def test_flaky_mark_overrides_command_line_options(testdir):
             assert len(b) > 3
         """
     )
-    testdir.makeconftest(
-        """
-        import pytest
-        from pytest_retry import attempts_key
+    pytester.makeconftest(
+        virtual_clock_conftest
+        + """
+    from pytest_retry import attempts_key
 
-        def pytest_sessionfinish(session: pytest.Session) -> None:
-            for item in session.items:
-                if item.name == "test_flaky_mark_options":
-                    assert item.stash[attempts_key] == 4
-                if item.name == "test_default_commandline_options":
-                    assert item.stash[attempts_key] == 3
-        """
+    def pytest_sessionfinish(session):
+        for item in session.items:
+            if item.name == "test_flaky_mark_options":
+                assert item.stash[attempts_key] == 4
+            if item.name == "test_default_commandline_options":
+                assert item.stash[attempts_key] == 3
+    """
     )
-    result = testdir.runpytest("--retries", "2", "--retry-delay", "1")
+    result = pytester.runpytest("--retries", "2", "--retry-delay", "1")
 
     assert_outcomes(result, passed=1, failed=1, retried=2)
-    assert result.duration > 2
-    assert result.duration < 3
+    assert recorded_delays(pytester) == [1, 1]
 
 
-def test_configuration_by_ini_file(testdir):
-    testdir.makeini(
+def test_configuration_by_ini_file(pytester):
+    pytester.makeini(
         """
         [pytest]
         retries = 2
@@ -806,118 +709,112 @@ def test_configuration_by_ini_file(testdir):
         cumulative_timing = true
         """
     )
-    testdir.makepyfile(
+    pytester.makepyfile(
         """
-        from time import sleep
         a = []
 
-        def test_ini_settings():
+        def test_ini_settings(sleep):
             sleep(2 - len(a))
             a.append(1)
             assert len(a) > 2
         """
     )
-    testdir.makeconftest(
-        """
-        import pytest
-        from pytest_retry import attempts_key
+    pytester.makeconftest(
+        virtual_clock_conftest
+        + """
+    from pytest_retry import attempts_key
 
-        def pytest_sessionfinish(session: pytest.Session) -> None:
-            for item in session.items:
-                assert item.stash[attempts_key] == 3
+    def pytest_sessionfinish(session):
+        for item in session.items:
+            assert item.stash[attempts_key] == 3
 
-        def pytest_report_teststatus(report: pytest.TestReport):
-            if report.when == "call" and report.outcome != "retried":
-                assert report.duration > 3
-                assert report.duration < 4
-        """
+    def pytest_report_teststatus(report):
+        if report.when == "call" and report.outcome != "retried":
+            assert report.duration == pytest.approx(3)
+    """
     )
-    result = testdir.runpytest()
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=1, retried=1)
+    assert recorded_delays(pytester) == [0.5, 0.5]
 
 
-def test_configuration_by_pyproject_toml_file(testdir):
-    testdir.makepyprojecttoml(
+def test_configuration_by_pyproject_toml_file(pytester):
+    pytester.makepyprojecttoml(
         """
         [tool.pytest.ini_options]
         retries = 1
         retry_delay = 0.3
         """
     )
-    testdir.makepyfile(
+    pytester.makepyfile(
         """
         def test_toml_settings():
             assert False
         """
     )
-    result = testdir.runpytest()
+    pytester.makeconftest(virtual_clock_conftest)
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=0, failed=1, retried=1)
-    assert result.duration > 0.3
-    assert result.duration < 0.7
+    assert recorded_delays(pytester) == [0.3]
 
 
-def test_duration_in_overwrite_timings_mode(testdir):
-    testdir.makepyfile(
+def test_duration_in_overwrite_timings_mode(pytester):
+    pytester.makepyfile(
         """
         import pytest
-        from time import sleep
 
         a = []
 
         @pytest.mark.flaky(retries=2)
-        def test_eventually_passes():
+        def test_eventually_passes(sleep):
             sleep(1.5 - len(a))
             a.append(1)
             assert len(a) > 1
         """
     )
-    testdir.makeconftest(
-        """
-        import pytest
-        from pytest_retry import attempts_key
-
-        def pytest_report_teststatus(report: pytest.TestReport):
-            if report.when == "call" and report.outcome != "retried":
-                assert report.duration < 0.7
-        """
+    pytester.makeconftest(
+        virtual_clock_conftest
+        + """
+    def pytest_report_teststatus(report):
+        if report.when == "call" and report.outcome != "retried":
+            assert report.duration == pytest.approx(0.5)
+    """
     )
-    result = testdir.runpytest()
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=1, retried=1)
 
 
-def test_duration_in_cumulative_timings_mode(testdir):
-    testdir.makepyfile(
+def test_duration_in_cumulative_timings_mode(pytester):
+    pytester.makepyfile(
         """
         import pytest
-        from time import sleep
 
         a = []
 
-        def test_eventually_passes():
+        def test_eventually_passes(sleep):
             sleep(2 - len(a))
             a.append(1)
             assert len(a) > 1
         """
     )
-    testdir.makeconftest(
-        """
-        import pytest
-
-        def pytest_report_teststatus(report: pytest.TestReport):
-            if report.when == "call" and report.outcome != "retried":
-                assert report.duration > 3
-        """
+    pytester.makeconftest(
+        virtual_clock_conftest
+        + """
+    def pytest_report_teststatus(report):
+        if report.when == "call" and report.outcome != "retried":
+            assert report.duration == pytest.approx(3)
+    """
     )
-    result = testdir.runpytest("--retries", "2", "--cumulative-timing", "1")
+    result = pytester.runpytest("--retries", "2", "--cumulative-timing", "1")
 
     assert_outcomes(result, passed=1, retried=1)
 
 
-def test_conditional_flaky_marks_evaluate_correctly(testdir):
-    testdir.makepyfile(
+def test_conditional_flaky_marks_evaluate_correctly(pytester):
+    pytester.makepyfile(
         """
         import pytest
 
@@ -941,30 +838,78 @@ def test_conditional_flaky_marks_evaluate_correctly(testdir):
             assert len(c) > 2
         """
     )
-    result = testdir.runpytest()
+    result = pytester.runpytest()
 
     assert_outcomes(result, passed=2, failed=1, retried=2)
 
 
 @mark.parametrize('verbosity', ['vv', 'vvv', 'vvvv'])
-def test_stack_trace_depth_uses_verbosity_count(testdir, verbosity):
-    testdir.makepyfile(
+def test_stack_trace_depth_uses_verbosity_count(pytester, verbosity):
+    pytester.makepyfile(eventually_passes(1))
+    result = pytester.runpytest("--retries", "1", f"-{verbosity}")
+
+    assert_outcomes(result, passed=1, retried=1)
+    assert sum(1 for line in result.outlines if line.startswith('\t  File')) == len(verbosity)
+
+
+def test_identical_failures_are_reported_for_every_attempt(pytester):
+    pytester.makepyfile(
         """
-        a = []
-        def test_eventually_passes():
-            a.append(1)
-            assert len(a) > 1
+        def test_fails_the_same_way():
+            raise ValueError("same every time")
         """
     )
-    result = testdir.runpytest("--retries", "1", f"-{verbosity}")
+    result = pytester.runpytest("--retries", "2")
 
-    assert_outcomes(result, passed=1, retried=1)
-    assert len([line for line in result.outlines if line.startswith('\t  File')]) == len(verbosity)
+    assert_outcomes(result, passed=0, failed=1, retried=1)
+    assert result.outlines.count("\tValueError: same every time") == 3
+
+
+def test_exception_with_broken_str_is_reported(pytester):
+    pytester.makepyfile(
+        """
+        import pytest
+
+        class Bad(Exception):
+            def __str__(self):
+                raise RuntimeError
+
+        @pytest.mark.flaky(retries=2)
+        def test_broken_str():
+            raise Bad
+        """
+    )
+    result = pytester.runpytest()
+
+    assert_outcomes(result, passed=0, failed=1, retried=1)
+    assert result.outlines.count("\ttest_broken_str failed after 3 attempts!") == 1
+
+
+def test_retry_report_keeps_most_recent_attempts(pytester, monkeypatch):
+    monkeypatch.setenv("PYTEST_RETRY_MAX_ATTEMPTS", "2")
+    pytester.makepyfile(
+        """
+        def test_first():
+            assert False
+
+        def test_second():
+            assert False
+        """
+    )
+    result = pytester.runpytest("--retries", "1")
+
+    assert_outcomes(result, passed=0, failed=2, retried=2)
+    assert "\t2 earlier attempts omitted" in result.outlines
+    assert "\ttest_first failed on attempt 1! Retrying!" not in result.outlines
+    assert "\ttest_first failed after 2 attempts!" not in result.outlines
+    assert "\ttest_second failed on attempt 1! Retrying!" in result.outlines
+    assert "\ttest_second failed after 2 attempts!" in result.outlines
 
 
 @xdist_test_marker
-def test_xdist_reporting_compatibility(testdir):
-    testdir.makepyfile(
+@nested_xdist_group
+def test_xdist_reporting_compatibility(pytester):
+    pytester.makepyfile(
         """
         a = 0
         b = 0
@@ -982,22 +927,46 @@ def test_xdist_reporting_compatibility(testdir):
             assert b == 2
         """
     )
-    result = testdir.runpytest("-n", "2", "--retries", "3")
+    result = pytester.runpytest("-n", "2", "--retries", "3")
+
+    lines = set(result.outlines)
+    assert "\ttest_flaky failed on attempt 1! Retrying!" in lines
+    assert "\ttest_flaky failed on attempt 2! Retrying!" in lines
+    assert "\ttest_flaky passed on attempt 3!" in lines
+    assert "\ttest_moar_flaky failed on attempt 1! Retrying!" in lines
+    assert "\ttest_moar_flaky passed on attempt 2!" in lines
+
+
+@xdist_test_marker
+@nested_xdist_group
+def test_xdist_retry_report_keeps_most_recent_attempts(pytester, monkeypatch):
+    monkeypatch.setenv("PYTEST_RETRY_MAX_ATTEMPTS", "2")
+    pytester.makepyfile(
+        """
+        def test_first():
+            assert False
+
+        def test_second():
+            assert False
+        """
+    )
+    result = pytester.runpytest("-n", "2", "--retries", "1")
 
-    assert "\ttest_flaky failed on attempt 1! Retrying!" in result.outlines
-    assert "\ttest_flaky failed on attempt 2! Retrying!" in result.outlines
-    assert "\ttest_flaky passed on attempt 3!" in result.outlines
-    assert "\ttest_moar_flaky failed on attempt 1! Retrying!" in result.outlines
-    assert "\ttest_moar_flaky passed on attempt 2!" in result.outlines
+    assert_outcomes(result, passed=0, failed=2, retried=2)
+    lines = set(result.outlines)
+    assert "\t2 earlier attempts omitted" in lines
+    reported = {f"\t{name} failed after 2 attempts!" for name in ("test_first", "test_second")}
+    assert len(reported & lines) == 1
 
 
 @xdist_test_marker
-def test_xdist_resources_properly_closed_server_side(testdir):
+@nested_xdist_group
+def test_xdist_resources_properly_closed_server_side(pytester):
     # TODO: This test works for the sockets opened in the main process,
     #       but there is no way to catch them inside the workers
     #       (or at least, the author of this test didn't find it)
 
-    testdir.makepyfile(
+    pytester.makepyfile(
         """
         a = 0
         b = 0
@@ -1018,7 +987,7 @@ def test_xdist_resources_properly_closed_server_side(testdir):
 
     # The test MUST be run in a subprocess because the warnings appear
     # on pytest teardown
-    result = testdir.runpytest_subprocess("-n", "2", "--retries", "3", "-W", "error")
+    result = pytester.runpytest_subprocess("-n", "2", "--retries", "3", "-W", "error")
 
     for line in result.errlines:
         assert "ResourceWarning" not in line